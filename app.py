@@ -2,14 +2,33 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import streamlit as st
+import http.client
+import io
+import mmap
 import os
 import re
 import zipfile
 import shutil
 import subprocess
 import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+VELA_TIMEOUT = 120  # seconds
+LOG_WINDOW_BYTES = 10_000  # bytes of Vela log previewed from the head and from the tail
+EXTRACT_FILES = {'trained.tflite'}  # zip members needed besides model-parameters/
+EXTRACT_DIRS = ('model-parameters/',)
+COPY_CHUNK = 1 << 20  # 1 MiB
+# Work in tmpfs when the host has it, so Vela's intermediate files stay in RAM
+SCRATCH_DIR = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
+
+# Label array in Edge Impulse's model_variables.h, and the quoted names inside it.
+# Byte patterns so the header can be scanned through mmap without decoding it.
+_CATEGORIES_RE = re.compile(rb'const char\*\s*ei_classifier_inferencing_categories.*?=\s*\{(.*?)\};', re.DOTALL)
+_LABEL_RE = re.compile(rb'"([^"]+)"')
+
 # --- Helper Functions from your Notebook ---
 
 def parse_model_zip_name(zip_path: str):
@@ -26,11 +45,11 @@ def parse_model_zip_name(zip_path: str):
     return modelname, version
 
 def safe_move(src: Path, dst: Path):
-    """Safely move a file, creating parent dirs and overwriting old file."""
+    """Safely move a file, creating parent dirs and overwriting old file.
+    Both paths live in the same temp dir, so os.replace is an atomic rename.
+    """
     dst.parent.mkdir(parents=True, exist_ok=True)
-    if dst.exists():
-        dst.unlink()
-    shutil.move(str(src), str(dst))
+    os.replace(src, dst)
 
 def find_vela_output(work_dir: Path, original_tflite_name: str) -> Path:
     """Find the output file from Vela.
@@ -43,18 +62,22 @@ def find_vela_output(work_dir: Path, original_tflite_name: str) -> Path:
     
     # Common vela output names
     possible_names = [
-        work_dir / f"{stem}_vela.tflite",
-        work_dir / "MOD00001.tfl", # As seen in your notebook log
-        work_dir / "output.tflite"
+        f"{stem}_vela.tflite",
+        "MOD00001.tfl", # As seen in your notebook log
+        "output.tflite"
     ]
+
+    # One directory scan instead of a stat per candidate
+    with os.scandir(work_dir) as entries:
+        names = {e.name for e in entries if e.is_file()}
     
-    for path in possible_names:
-        if path.exists():
-            return path
+    for name in possible_names:
+        if name in names:
+            return work_dir / name
             
     # Check if it overwrote the original (less common, but possible)
     original_path = work_dir / original_tflite_name
-    if original_path.exists():
+    if original_tflite_name in names:
         # This is tricky; we assume if no other file exists, it's this one.
         # A more robust check might be needed if vela behavior is unknown.
         st.warning(f"Could not find a distinct Vela output file. Assuming {original_tflite_name} was overwritten.")
@@ -63,33 +86,102 @@ def find_vela_output(work_dir: Path, original_tflite_name: str) -> Path:
     raise FileNotFoundError(f"Could not find Vela output file in {work_dir}. Looked for {possible_names}.")
 
 
+def extract_needed(z: zipfile.ZipFile, work_dir: Path):
+    """Extract only the members the pipeline uses, one at a time.
+    Each member is streamed through a COPY_CHUNK window instead of extractall.
+    """
+    root = work_dir.resolve()
+    for info in z.infolist():
+        if info.is_dir():
+            continue
+        if info.filename not in EXTRACT_FILES and not info.filename.startswith(EXTRACT_DIRS):
+            continue
+        dst = work_dir / info.filename
+        if not dst.resolve().is_relative_to(root):
+            raise ValueError(f"Refusing to extract {info.filename}: path escapes the work directory")
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        with z.open(info) as src, open(dst, 'wb') as dst_f:
+            shutil.copyfileobj(src, dst_f, COPY_CHUNK)
+
+def extract_labels(vars_h_path: Path) -> list:
+    """Return the class labels declared in Edge Impulse's model_variables.h."""
+    if not vars_h_path.stat().st_size:  # mmap rejects empty files
+        return []
+    with open(vars_h_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        match = _CATEGORIES_RE.search(mm)
+        if not match:
+            return []
+        return [b.decode('utf-8', 'replace') for b in _LABEL_RE.findall(match.group(1))]
+
+def log_preview(log_path: Path) -> str:
+    """Return the log, or just its first and last LOG_WINDOW_BYTES if it is longer."""
+    with open(log_path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(0)
+        if size <= 2 * LOG_WINDOW_BYTES:
+            text = f.read()
+        else:
+            head = f.read(LOG_WINDOW_BYTES)
+            f.seek(-LOG_WINDOW_BYTES, os.SEEK_END)
+            text = head + b'\n...\n' + f.read()
+    return text.decode('utf-8', 'replace')
+
+def run_logged(cmd, log_path: Path, timeout: float = VELA_TIMEOUT) -> int:
+    """Run cmd with its combined stdout/stderr redirected to log_path.
+    The kernel writes the log directly, so no pipe data passes through Python.
+    Returns the process return code; raises subprocess.TimeoutExpired on timeout.
+    """
+    with open(log_path, 'wb') as log:
+        return subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT, timeout=timeout).returncode
+
+
 # --- Main Conversion Logic ---
 
 def run_conversion(uploaded_file):
     """
     Takes an uploaded file object, runs the full conversion pipeline,
-    and returns the bytes of the final Manifest.zip (or None on failure).
+    and returns the bytes of the final Manifest.zip.
     Returning bytes avoids TemporaryDirectory cleanup race conditions
     when Streamlit re-runs the script.
     """
+    st.write(f"Processing {uploaded_file.name}...")
+    st.write("Running Vela conversion...")
+    try:
+        manifest_bytes, vela_log, vela_name, labels = _convert_bytes(uploaded_file.getvalue(), uploaded_file.name)
+    except subprocess.CalledProcessError as e:
+        st.code(e.output)
+        raise RuntimeError(f"Vela conversion FAILED. Return code: {e.returncode}") from e
+
+    st.write("File unzipped. Found trained.tflite and model_variables.h.")
+    st.code(vela_log)
+    st.write("Vela conversion successful.")
+    st.write(f"Vela model saved as: {vela_name}")
+    st.write(f"Labels extracted: {labels}")
+    st.success("Manifest.zip created successfully!")
+    return manifest_bytes
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _convert_bytes(zip_bytes: bytes, file_name: str):
+    """Run the pipeline on the raw zip bytes.
+    Returns (Manifest.zip bytes, Vela log preview, Vela model file name, labels)
+    and raises on any failure, so only successful conversions are cached.
+    Streamlit hashes the arguments to form the cache key, so converting the
+    same upload again skips the Vela subprocess entirely. Progress, the log
+    and results are rendered by run_conversion; the only element recorded for
+    replay on a cache hit is find_vela_output's fallback warning.
+    """
     # Create a temporary directory to work in
-    with tempfile.TemporaryDirectory() as temp_dir:
+    with tempfile.TemporaryDirectory(dir=SCRATCH_DIR) as temp_dir:
         base_path = Path(temp_dir)
         
-        # 1. Save uploaded file
-        uploaded_zip_path = base_path / uploaded_file.name
-        with open(uploaded_zip_path, 'wb') as f:
-            f.write(uploaded_file.getbuffer())
-
-        # 2. Unzip and validate
-        st.write(f"Processing {uploaded_file.name}...")
-        model_name, model_version = parse_model_zip_name(str(uploaded_zip_path))
+        # 1. Unzip straight from memory and validate
+        model_name, model_version = parse_model_zip_name(file_name)
         container_name = f"{model_name}-custom-{model_version}"
         work_dir = base_path / 'work' / container_name
         work_dir.mkdir(parents=True, exist_ok=True)
 
-        with zipfile.ZipFile(uploaded_zip_path, 'r') as z:
-            z.extractall(work_dir)
+        with zipfile.ZipFile(io.BytesIO(zip_bytes), 'r') as z:
+            extract_needed(z, work_dir)
 
         tflite_path = work_dir / 'trained.tflite'
         vars_h_path = work_dir / 'model-parameters' / 'model_variables.h'
@@ -98,12 +190,8 @@ def run_conversion(uploaded_file):
             raise FileNotFoundError(f"trained.tflite not found at {tflite_path}")
         if not vars_h_path.exists():
             raise FileNotFoundError(f"model_variables.h not found at {vars_h_path}")
-        
-        st.write("File unzipped. Found trained.tflite and model_variables.h.")
 
-        # 3. Run Vela conversion
-        st.write("Running Vela conversion...")
-        
+        # 2. Run Vela conversion
         # Note: Vela config is hardcoded as in your notebook
         cmd = [
             'vela',
@@ -112,87 +200,68 @@ def run_conversion(uploaded_file):
             '--output-dir', str(work_dir),
             str(tflite_path),
         ]
+        log_path = work_dir / 'vela.log'
 
-        try:
-            res = subprocess.run(cmd, capture_output=True, text=True, check=True, timeout=120)
-            st.code(res.stdout)
-            if res.stderr:
-                st.warning(f"Vela stderr:\n{res.stderr}")
-        except subprocess.CalledProcessError as e:
-            st.error(f"Vela conversion FAILED. Return code: {e.returncode}")
-            st.error(f"Stdout:\n{e.stdout}")
-            st.error(f"Stderr:\n{e.stderr}")
-            return None
-        except FileNotFoundError:
-            st.error("Vela command not found. This app is likely not deployed correctly.")
-            return None
-            
-        st.write("Vela conversion successful.")
+        # The header parse doesn't depend on Vela output, so it runs on a
+        # worker thread while Vela runs here.
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            labels_future = pool.submit(extract_labels, vars_h_path)
+            try:
+                returncode = run_logged(cmd, log_path)
+            except FileNotFoundError:
+                raise RuntimeError("Vela command not found. This app is likely not deployed correctly.") from None
+
+        vela_log = log_preview(log_path)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd, output=vela_log)
 
         # Find the output file and rename it
         vela_original_output = find_vela_output(work_dir, tflite_path.name)
         vela_final_path = work_dir / f"{container_name}_vela.tflite"
         safe_move(vela_original_output, vela_final_path)
-        st.write(f"Vela model saved as: {vela_final_path.name}")
 
 
-        # 4. Extract labels
-        with open(vars_h_path, 'r', encoding='utf-8', errors='replace') as f:
-            content = f.read()
-
-        match = re.search(r'const char\*\s*ei_classifier_inferencing_categories.*?=\s*\{(.*?)\};', content, re.DOTALL)
-        if match:
-            labels = re.findall(r'\"([^\"]+)\"', match.group(1))
-        else:
-            labels = []
+        # 3. Extract labels
+        labels = labels_future.result()
 
         if not labels:
             raise RuntimeError('No labels found in model_variables.h.')
 
-        labels_txt_path = work_dir / 'labels.txt'
-        with open(labels_txt_path, 'w') as f:
-            f.write('\n'.join(labels))
-        
-        st.write(f"Labels extracted: {labels}")
-
-        # 5. Package Manifest
-        manifest_dir = work_dir / 'Manifest'
-        manifest_dir.mkdir(parents=True, exist_ok=True)
-
-        shutil.copy2(vela_final_path, manifest_dir / vela_final_path.name)
-        shutil.copy2(labels_txt_path, manifest_dir / 'labels.txt')
-
-        # Zip Manifest using STORE (no compression)
-        manifest_dir_path = work_dir / 'Manifest'
-        manifest_zip_path = work_dir / 'Manifest.zip'
-        # Create a store-compressed zip so files are stored without deflate
-        with zipfile.ZipFile(manifest_zip_path, mode='w', compression=zipfile.ZIP_STORED) as zf:
-            for root, _, files in os.walk(manifest_dir_path):
-                for fname in files:
-                    full_path = Path(root) / fname
-                    # write with arcname relative to Manifest directory
-                    arcname = full_path.relative_to(work_dir)
-                    zf.write(full_path, arcname)
-
-        final_zip_path = manifest_zip_path
-        if not final_zip_path.exists():
-            raise FileNotFoundError(f"Failed to create Manifest.zip at {final_zip_path}")
-
-        # Read bytes while tempdir is still valid and return them to caller
-        with open(final_zip_path, 'rb') as f:
-            manifest_bytes = f.read()
-
-        st.success("Manifest.zip created successfully!")
-        return manifest_bytes
+        # 4. Package Manifest in memory; no Manifest dir or zip on disk.
+        # Store-compressed so files are stored without deflate. The quantized
+        # tflite barely deflates anyway, so storing it also saves the CPU.
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, mode='w', compression=zipfile.ZIP_STORED) as zf:
+            zf.write(vela_final_path, arcname=f"Manifest/{vela_final_path.name}",
+                     compress_type=zipfile.ZIP_STORED)
+            # Same regular-file mode and timestamp a file on disk would get
+            labels_info = zipfile.ZipInfo("Manifest/labels.txt", date_time=time.localtime()[:6])
+            labels_info.external_attr = 0o100644 << 16
+            labels_info.compress_type = zipfile.ZIP_STORED
+            zf.writestr(labels_info, '\n'.join(labels))
+
+        return buf.getvalue(), vela_log, vela_final_path.name, labels
 
 # --- Streamlit UI ---
 
+LOGO_URL = "http://wildlife.ai/wp-content/uploads/2025/10/wildlife_ai_logo_dark_lightbackg_1772x591.png"
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def _logo():
+    """Fetch the logo once a day instead of on every rerun.
+    A failed fetch is cached too, as LOGO_URL, so an unreachable host or a
+    garbled response doesn't stall or break every rerun; the browser then
+    fetches the image itself.
+    """
+    try:
+        with urllib.request.urlopen(LOGO_URL, timeout=5) as resp:
+            return resp.read()
+    except (OSError, http.client.HTTPException):
+        return LOGO_URL
+
 st.set_page_config(layout="centered")
 
-st.image(
-    "http://wildlife.ai/wp-content/uploads/2025/10/wildlife_ai_logo_dark_lightbackg_1772x591.png",
-    use_container_width=True,
-)
+st.image(_logo(), use_container_width=True)
 st.title("Edge Impulse Model Converter (Vela)")
 st.markdown("""
 Upload your Edge Impulse model zip file (e.g., `model-custom-v1.zip`).
@@ -216,24 +285,21 @@ uploaded_file = st.file_uploader(
 
 if uploaded_file is not None:
     if st.button(f"Convert {uploaded_file.name}"):
-        
-        zip_bytes = None
+        # Drop any earlier result so a failed run never offers a stale Manifest
+        st.session_state.pop('manifest_bytes', None)
         try:
             with st.spinner("Running conversion pipeline... This may take a minute."):
-                # run_conversion now returns bytes
-                zip_bytes = run_conversion(uploaded_file)
-                # store in session state so subsequent reruns keep the bytes
-                if zip_bytes:
-                    st.session_state['manifest_bytes'] = zip_bytes
-
+                # run_conversion returns bytes; store them in session state
+                # so subsequent reruns keep the bytes
+                st.session_state['manifest_bytes'] = run_conversion(uploaded_file)
         except Exception as e:
             st.error(f"An error occurred: {e}")
 
-        # Use session_state stored bytes for the download button
-        if 'manifest_bytes' in st.session_state and st.session_state['manifest_bytes']:
+        zip_bytes = st.session_state.get('manifest_bytes')
+        if zip_bytes:
             st.download_button(
                 label="Download Manifest.zip",
-                data=st.session_state['manifest_bytes'],
+                data=zip_bytes,
                 file_name="Manifest.zip",
                 mime="application/zip"
             )